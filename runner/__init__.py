@@ -1,137 +1,225 @@
 import asyncio
+import functools
 from importlib import import_module
 import os.path
 import argparse
-from multiprocessing import Process
+from dataclasses import dataclass
+from multiprocessing import get_context
+from multiprocessing.connection import wait
 import sys
 import logging
 import signal
-from time import time
-import math
-from typing import List, Any, Optional, Callable, Coroutine
+from time import monotonic
+from typing import List, Any, Optional, Callable, Coroutine, Sequence, cast
 
 logger = logging.getLogger(__name__)
 
-before_start_events: List[
-    Callable[[Any], None]
-    | Callable[[Any], Coroutine[Any, Any, None]],
-] = []
-after_stop_events: List[
-    Callable[[Any], None]
-    | Callable[[Any], Coroutine[Any, Any, None]],
-] = []
+_FORMATTER = logging.Formatter(
+    "[%(asctime)s] %(name)s:%(lineno)d %(levelname)s - %(message)s"
+)
 
-stop_event: Optional[asyncio.Event] = None
-global_task: Optional[asyncio.Task[Any]] = None
+SyncEvent = Callable[[Any], None]
+AsyncEvent = Callable[[Any], Coroutine[Any, Any, None]]
 
-
-def mod60(t: int) -> tuple[int, int]:
-    return math.floor(t / 60), t % 60
+# Events are split by kind when registered so running them needs no
+# further introspection.
+sync_before_start_events: List[SyncEvent] = []
+async_before_start_events: List[AsyncEvent] = []
+sync_after_stop_events: List[SyncEvent] = []
+async_after_stop_events: List[AsyncEvent] = []
 
 
 def pretty_time(t: int) -> str:
-    out = []
-    for i in range(2):
-        t, v = mod60(t)
+    h, rem = divmod(int(t), 3600)
+    m, s = divmod(rem, 60)
+    return f'{h:02d}:{m:02d}:{s:02d}'
+
+
+@dataclass
+class RunContext:
+    task: Optional[asyncio.Task[Any]] = None
+    stopped: bool = False
+
+    def on_sigint(self) -> None:
+        # Always called as an event loop callback, never from inside a
+        # signal handler, so a second SIGINT cannot interrupt it midway;
+        # it is queued and sees stopped already set.
+        logger.error('KeyboardInterrupt Error')
+        if self.stopped:
+            sys.exit(1)
 
-        v_s = f'0{v}'
-        out.append(v_s[-2:])
+        self.stopped = True
+        if self.task:
+            self.task.cancel()
 
-        if t == 0:
-            break
 
-    if t < 10:
-        out.append('0' + str(t))
-    else:
-        out.append(str(t))
-    out.reverse()
-    return ':'.join(out)
+def _add_sigint_handler(
+    loop: asyncio.AbstractEventLoop,
+    callback: Callable[[], None],
+) -> None:
+    try:
+        loop.add_signal_handler(signal.SIGINT, callback)
+    except NotImplementedError:
+        # Windows event loops have no add_signal_handler, hand the
+        # callback over to the loop from a plain signal handler instead.
+        signal.signal(
+            signal.SIGINT,
+            lambda signum, frame: loop.call_soon_threadsafe(callback),
+        )
 
 
-def sigint_handler(signal: int, frame: Any) -> None:
-    logger.error('KeyboardInterrupt Error')
-    if stop_event:
-        if stop_event.is_set():
-            sys.exit(1)
+def _remove_sigint_handler(loop: asyncio.AbstractEventLoop) -> None:
+    try:
+        loop.remove_signal_handler(signal.SIGINT)
+    except NotImplementedError:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
 
-        stop_event.set()
+def _ensure_logging() -> None:
+    if logging.root.handlers:
+        return
 
-    if global_task:
-        global_task.cancel()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(_FORMATTER)
+    logging.root.addHandler(handler)
+    logging.root.setLevel(logging.INFO)
 
 
+@functools.lru_cache(maxsize=128)
 def fixed_module_name(module_name: str) -> str:
-    if os.path.isfile(module_name):
-        if module_name.endswith('.py'):
-            module_name = module_name[:-3]
+    path = module_name.replace(os.altsep or os.sep, os.sep)
+    if os.sep not in path and not path.endswith('.py'):
+        return module_name
+
+    if os.path.isfile(path):
+        if path.endswith('.py'):
+            path = path[:-3]
 
-        if module_name.startswith('./'):
-            module_name = module_name[2:]
+        if path.startswith('.' + os.sep):
+            path = path[2:]
 
-        return module_name.replace('/', '.')
+        return path.replace(os.sep, '.')
 
     return module_name
 
 
-def before_start(
-    evt: Callable[[Any], None] | Callable[[Any], Coroutine[Any, Any, None]]
-) -> None:
-    before_start_events.append(evt)
+def before_start(evt: SyncEvent | AsyncEvent) -> None:
+    if asyncio.iscoroutinefunction(evt):
+        async_before_start_events.append(evt)
+    else:
+        sync_before_start_events.append(cast(SyncEvent, evt))
 
 
-def after_stop(
-    evt: Callable[[Any], None] | Callable[[Any], Coroutine[Any, Any, None]]
-) -> None:
-    after_stop_events.append(evt)
+def after_stop(evt: SyncEvent | AsyncEvent) -> None:
+    if asyncio.iscoroutinefunction(evt):
+        async_after_stop_events.append(evt)
+    else:
+        sync_after_stop_events.append(cast(SyncEvent, evt))
 
 
-async def aio_run(module: Any, *argv: str) -> None:
-    global stop_event
-    global global_task
+async def _gather_events(evts: List[AsyncEvent], module: Any) -> None:
+    await asyncio.gather(*[evt(module) for evt in evts])
 
-    signal.signal(signal.SIGINT, sigint_handler)
 
-    for evt in before_start_events:
-        if asyncio.iscoroutinefunction(evt):
-            await evt(module)
-        else:
-            evt(module)
+async def aio_run(module: Any, *argv: str) -> None:
+    for evt in sync_before_start_events:
+        evt(module)
 
-    stop_event = asyncio.Event()
+    await _gather_events(async_before_start_events, module)
 
-    async def main_task() -> None:
-        try:
-            await module.main(*argv)
-        finally:
-            stop_event.set()
+    ctx = RunContext(task=asyncio.current_task())
+    loop = asyncio.get_running_loop()
+    _add_sigint_handler(loop, ctx.on_sigint)
 
     try:
-        global_task = asyncio.create_task(main_task())
-        if stop_event:
-            await stop_event.wait()
+        await module.main(*argv)
+    except asyncio.CancelledError:
+        # Only the cancellation requested by on_sigint is a normal stop.
+        if not ctx.stopped:
+            raise
     finally:
-        for evt in after_stop_events:
-            if asyncio.iscoroutinefunction(evt):
-                await evt(module)
-            else:
+        if ctx.stopped and ctx.task and sys.version_info >= (3, 11):
+            # Let after_stop coroutines use asyncio.timeout/TaskGroup.
+            ctx.task.uncancel()
+        ctx.stopped = True
+        try:
+            for evt in sync_after_stop_events:
                 evt(module)
 
+            await _gather_events(async_after_stop_events, module)
+        finally:
+            _remove_sigint_handler(loop)
+
+
+def _cancel_all_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    # Same cleanup asyncio.run() does for tasks left behind by events.
+    tasks = asyncio.all_tasks(loop)
+    if not tasks:
+        return
+
+    for task in tasks:
+        task.cancel()
+
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    for task in tasks:
+        if task.cancelled():
+            continue
+
+        if task.exception() is not None:
+            loop.call_exception_handler({
+                'message': 'unhandled exception during runner shutdown',
+                'exception': task.exception(),
+                'task': task,
+            })
+
+
+def _run_events(
+    sync_evts: List[SyncEvent],
+    async_evts: List[AsyncEvent],
+    module: Any,
+    loop: Optional[asyncio.AbstractEventLoop],
+) -> None:
+    for evt in sync_evts:
+        evt(module)
+
+    if loop is not None and async_evts:
+        loop.run_until_complete(_gather_events(async_evts, module))
+
 
 def run(module: Any, *argv: str) -> None:
-    for evt in before_start_events:
-        if asyncio.iscoroutinefunction(evt):
-            asyncio.run(evt(module))
-        else:
-            evt(module)
+    # One loop serves both before_start and after_stop coroutines.
+    loop = None
+    if async_before_start_events or async_after_stop_events:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
 
     try:
-        module.main(*argv)
+        _run_events(
+            sync_before_start_events,
+            async_before_start_events,
+            module,
+            loop,
+        )
+
+        try:
+            module.main(*argv)
+        finally:
+            _run_events(
+                sync_after_stop_events,
+                async_after_stop_events,
+                module,
+                loop,
+            )
     finally:
-        for evt in after_stop_events:
-            if asyncio.iscoroutinefunction(evt):
-                asyncio.run(evt(module))
-            else:
-                evt(module)
+        if loop is not None:
+            try:
+                _cancel_all_tasks(loop)
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.run_until_complete(loop.shutdown_default_executor())
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
 
 
 def start(
@@ -140,16 +228,18 @@ def start(
     processes: Optional[int] = None,
     process_id: Optional[int] = None,
 ) -> None:
-    formatter = "[%(asctime)s] %(name)s:%(lineno)d %(levelname)s - %(message)s"
-    logging.basicConfig(level=logging.INFO, format=formatter)
-    module_log = f'running module {module_name} {" ".join(argv)}'
-    logger.info(f'Start {module_log}')
-    start_time = time()
+    _ensure_logging()
+    log_enabled = logger.isEnabledFor(logging.INFO)
+    joined_argv = ' '.join(argv) if log_enabled else ''
+    logger.info('Start running module %s %s', module_name, joined_argv)
+    start_time = monotonic()
     module = import_module(fixed_module_name(module_name))
 
     if process_id is not None:
-        os.environ['PROCESS_ID'] = str(process_id)
-        os.environ['PROCESSES'] = str(processes)
+        os.environ.update({
+            'PROCESS_ID': str(process_id),
+            'PROCESSES': str(processes),
+        })
 
     if hasattr(module, 'parse_args'):
         argv = [module.parse_args(argv)]
@@ -159,45 +249,38 @@ def start(
     else:
         run(module, *argv)
 
-    logger.info(f'Finish {module_log}')
+    logger.info('Finish running module %s %s', module_name, joined_argv)
 
-    t = round(time() - start_time, 4)
-    logger.info(f'Spent: {t}s')
-    t_s = pretty_time(int(t))
-    logger.info(f'Spent: {t_s}')
+    if log_enabled:
+        t = round(monotonic() - start_time, 4)
+        logger.info('Spent: %ss', t)
+        logger.info('Spent: %s', pretty_time(int(t)))
 
 
-def split_argv(argv: List[str]) -> tuple[List[str], List[str]]:
+def split_argv(argv: Sequence[str]) -> tuple[List[str], List[str]]:
     script_argv = []
-    is_module_argv = False
-    module_argv = []
-
-    argv = list(argv)
-    argv.reverse()
-
-    while True:
-        if len(argv) == 0:
-            break
+    i = 0
+    n = len(argv)
 
-        arg = argv.pop()
+    while i < n:
+        arg = argv[i]
+        i += 1
+        script_argv.append(arg)
 
-        if is_module_argv:
-            module_argv.append(arg)
-        else:
-            script_argv.append(arg)
-            if arg.startswith('-'):
-                if arg.find('=') == -1:
-                    if len(argv) > 0:
-                        script_argv.append(argv.pop())
+        if not arg.startswith('-'):
+            # The first positional is the module name, everything after it
+            # belongs to the module.
+            return script_argv, list(argv[i:])
 
-            else:
-                is_module_argv = True
+        if '=' not in arg and i < n:
+            script_argv.append(argv[i])
+            i += 1
 
-    return script_argv, module_argv
+    return script_argv, []
 
 
 def main(script: str, *argv: str) -> None:
-    script_argv, module_argv = split_argv(list(argv))
+    script_argv, module_argv = split_argv(argv)
     parser = argparse.ArgumentParser(description='Prepare and Run command.')
     parser.add_argument(
         '-p',
@@ -224,33 +307,51 @@ def main(script: str, *argv: str) -> None:
     args = parser.parse_args(script_argv)
 
     if args.processes > 1:
+        # fork is cheap on Linux; children still import the module
+        # themselves, after the fork, so import-time state is never shared.
+        if sys.platform.startswith('linux'):
+            ctx = get_context('fork')
+        else:
+            ctx = get_context('spawn')
+
+        # Each worker runs module.main once for the lifetime of the
+        # process, so there is nothing for a Pool to reuse. Dedicated
+        # non-daemonic processes also let workers spawn children of their
+        # own and let us stop the whole group when any one of them exits.
         processes = []
         for i in range(args.processes):
-            p = Process(
+            p = ctx.Process(
                 target=start,
                 args=(args.module_name, module_argv, args.processes, i + 1),
             )
             p.start()
             processes.append(p)
 
-
         if args.wait_all_stop:
             for p in processes:
                 p.join()
 
-        running = True
-        while running:
-            for p in processes:
-                p.join(10)
-                if not p.is_alive():
-                    running = False
-                    break
+        # Block until any child exits, then stop the rest.
+        sentinels = {p.sentinel: p for p in processes}
+        for sentinel in wait(list(sentinels)):
+            sentinels.pop(cast(int, sentinel)).join(0)
 
-        for p in processes:
+        for p in sentinels.values():
             p.terminate()
-            p.join(10)
-            if p.is_alive():
-                p.kill()
+
+        # Give all children one shared grace period instead of one each.
+        deadline = monotonic() + 10
+        while sentinels:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+
+            for sentinel in wait(list(sentinels), timeout):
+                sentinels.pop(cast(int, sentinel)).join()
+
+        for p in sentinels.values():
+            p.kill()
+            p.join()
     else:
         start(args.module_name, module_argv)
 